@@ -7,6 +7,8 @@ from __future__ import absolute_import, division, print_function
 import logging
 import os
 import re
+import shutil
+import subprocess
 import sys
 import traceback
 from typing import Dict, Tuple  # noqa: F401
@@ -24,17 +26,22 @@ debug, info, warn = logger.debug, logger.info, logger.warning
 # Set axis tick positions manually.  Accounts for reciprocal(-square) d-scaling.
 d_ticks = [5, 3, 2, 1.5, 1, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4]
 
+# The last contiguous group of numerals (or hashes) before a file extension.
+_image_number = re.compile(r"([0-9#]+)(?=\.\w)")
+
 
 def terminal_size(procrunner_debug=False):
     """
     Find the current size of the terminal window.
 
-    :param procrunner_debug:
+    :param procrunner_debug: Only used on Python 2, where `stty` is consulted.
     :return: Number of columns; number of rows.
     :rtype: Tuple[int]
     """
     columns, rows = 80, 25
-    if sys.stdout.isatty():
+    if hasattr(shutil, "get_terminal_size"):
+        columns, rows = shutil.get_terminal_size((columns, rows))
+    elif sys.stdout.isatty():
         try:
             result = procrunner.run(
                 ["stty", "size"],
@@ -91,7 +98,7 @@ def make_template(f):
     directory, f = os.path.split(f)
     # Split off the file extension, assuming it begins at the first full stop,
     # also split the last contiguous group of digits off the filename root
-    parts = re.split(r"([0-9#]+)(?=\.\w)", f, 1)
+    parts = _image_number.split(f, 1)
     # Get the number of digits in the group we just isolated and their value
     try:
         # Combine the root, a hash for each digit and the extension
@@ -124,7 +131,7 @@ def plot_intensities(
     :param ylabel:
     :param xticks:
     :param style:
-    :param procrunner_debug:
+    :param procrunner_debug: Unused, retained for backwards compatibility.
     """
     columns, rows = terminal_size()
 
@@ -140,38 +147,54 @@ def plot_intensities(
         "set ytics out",
         "plot '-' using 1:2 title '' %s" % style,
     ]
-    for x in sorted(bins.keys()):
-        plot_commands.append("%f %d" % (x * hist_value_factor, bins[x]))
-    plot_commands.append("e")
-
-    debug("running %s with:\n  %s\n", " ".join(command), "\n  ".join(plot_commands))
+    # Write the plot data straight to the gnuplot input buffer.
+    plot_input = bytearray("\n".join(plot_commands).encode("utf-8") + b"\n")
+    for x, count in sorted(bins.items()):
+        plot_input += b"%f %d\n" % (x * hist_value_factor, count)
+    plot_input += b"e\n"
+
+    if logger.isEnabledFor(logging.DEBUG):
+        debug(
+            "running %s with:\n  %s\n",
+            " ".join(command),
+            plot_input.decode("utf-8").rstrip().replace("\n", "\n  "),
+        )
 
+    # The gnuplot output is small, so there is no need for procrunner's threaded
+    # stream readers.  Simply pipe the plot in and collect the output at the end.
     try:
-        result = procrunner.run(
+        gnuplot = subprocess.Popen(
             command,
-            stdin="\n".join(plot_commands).encode("utf-8") + b"\n",
-            timeout=120,
-            print_stdout=False,
-            print_stderr=False,
-            debug=procrunner_debug,
-            environment_override={"LD_LIBRARY_PATH": ""},
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=dict(os.environ, LD_LIBRARY_PATH=""),
         )
+        if sys.version_info.major > 2:
+            try:
+                stdout, stderr = gnuplot.communicate(bytes(plot_input), timeout=120)
+            except subprocess.TimeoutExpired:
+                gnuplot.kill()
+                stdout, stderr = gnuplot.communicate()
+        else:
+            # Python 2 does not support a timeout here.
+            stdout, stderr = gnuplot.communicate(bytes(plot_input))
+        result = {"exitcode": gnuplot.returncode, "stdout": stdout, "stderr": stderr}
     except OSError:
         info(traceback.format_exc())
         result = {}
 
-    debug("result = %s", prettyprint_dictionary(result))
+    if logger.isEnabledFor(logging.DEBUG):
+        debug("result = %s", prettyprint_dictionary(result))
 
     if result["exitcode"] == 0:
-        star = re.compile(r"\*")
         state = set()
         for line in result["stdout"].decode("utf-8").split("\n"):
             if line.strip() != "":
-                stars = {m.start(0) for m in re.finditer(star, line)}
-                if not stars:
+                if "*" not in line:
                     state = set()
                 else:
-                    state |= stars
+                    state |= {i for i, c in enumerate(line) if c == "*"}
                     line = list(line)
                     for s in state:
                         line[s] = "*"
@@ -44,17 +44,19 @@ Examples:
 
 from __future__ import absolute_import, division, print_function
 
-import json
 import logging
 import math
 import os
 import re
+import subprocess
 import sys
+import tempfile
 import time
 import timeit
 from glob import glob
-from typing import Dict, List, Optional, Sequence, Tuple
+from typing import IO, Dict, List, Optional, Sequence, Tuple
 
+import numpy as np
 import procrunner
 from six.moves.cPickle import PickleError
 
@@ -64,12 +66,12 @@ from libtbx.introspection import number_of_processors
 from libtbx.phil import scope
 
 import dials.command_line.integrate
-import dials.util.version
 import screen19
 from dials.algorithms.indexing import DialsIndexError
 from dials.algorithms.indexing.bravais_settings import (
     refined_settings_from_refined_triclinic,
 )
+from dials.algorithms.profile_model.factory import ProfileModelFactory
 from dials.algorithms.shoebox import MaskCode
 from dials.array_family import flex
 from dials.command_line.dials_import import MetaDataUpdater
@@ -93,8 +95,24 @@ from dxtbx.model.experiment_list import (
 )
 from screen19.minimum_exposure import suggest_minimum_exposure
 
+# Prefer a faster JSON parser, if one is available.
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
+
 Templates = List[Tuple[str, Tuple[int, int]]]
 
+# The table of candidate Bravais settings in the dials.refine_bravais_settings log.
+_bravais_table = re.compile(r"[-+]{3,}\n[^\n]*\n[-+|]{3,}\n(.*\n)*[-+]{3,}")
+
 phil_scope = iotbx.phil.parse(
     u"""
     verbosity = 0
@@ -245,6 +263,120 @@ def _run_integration(scope, experiments_file, reflections_file):
     return expts, refls
 
 
+def _start_report(experiments, reflections):
+    # type: (str, str) -> Tuple[subprocess.Popen, IO[bytes], float]
+    """
+    Start `dials.report` running in the background.
+
+    The combined stdout and stderr of `dials.report` are captured in a temporary
+    file, so that they neither interleave with the screen19 log nor stall the
+    subprocess on a full pipe.
+
+    Args:
+        experiments:  Path to the experiment list file.
+        reflections:  Path to the corresponding reflection table file.
+
+    Returns:
+        The `dials.report` process, its output file and its start time.
+    """
+    command = ["dials.report", experiments, reflections]
+    debug("running %s", command)
+    output = tempfile.TemporaryFile()
+    start = timeit.default_timer()
+    process = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT)
+    return process, output, start
+
+
+def _read_overload_data(filename):  # type: (str) -> Dict
+    """
+    Read the JSON output of xia2.overload.
+
+    If pysimdjson is available, the potentially very long list of histogram bins is
+    copied straight into a numpy array, without creating a Python object per bin.
+
+    Args:
+        filename:  Path to the xia2.overload JSON output file.
+
+    Returns:
+        The xia2.overload output data.
+    """
+    with open(filename, "rb") as fh:
+        data = fh.read()
+
+    if simdjson is None:
+        return json_loads(data)
+
+    document = simdjson.Parser().parse(data)
+    overload_data = {}
+    for key in document.keys():
+        value = document[key]
+        if key == "bins":
+            value = np.frombuffer(value.as_buffer(of_type="i"), dtype=np.int64)
+        elif isinstance(value, simdjson.Object):
+            value = value.as_dict()
+        elif isinstance(value, simdjson.Array):
+            value = value.as_list()
+        overload_data[key] = value
+
+    return overload_data
+
+
+def _intensity_histogram(overload_data):
+    # type: (Dict) -> Tuple[np.ndarray, np.ndarray]
+    """
+    Extract the pixel intensity histogram from the xia2.overload output.
+
+    Both the 'bins' and the older 'counts' layouts of the output are understood.
+
+    Args:
+        overload_data:  The xia2.overload output data.
+
+    Returns:
+        A sorted array of the populated pixel count values and an array of the
+        corresponding numbers of pixels.
+    """
+    if "bins" in overload_data:
+        bins = np.asarray(
+            overload_data["bins"][: overload_data["bin_count"]], dtype=np.int64
+        )
+        values = np.flatnonzero(bins > 0)
+        return values, bins[values]
+
+    values = np.array([int(k) for k in overload_data["counts"]], dtype=np.int64)
+    counts = np.array(list(overload_data["counts"].values()), dtype=np.int64)
+    order = np.argsort(values)
+    values, counts = values[order], counts[order]
+    populated = values > 0
+    return values[populated], counts[populated]
+
+
+def _rebin_histogram(values, counts, factor):
+    # type: (np.ndarray, np.ndarray, float) -> Dict[int, int]
+    """
+    Rebin a histogram onto a new scale.
+
+    Each value is multiplied by `factor` and rounded to the nearest integer bin of
+    the new scale.  Bins at or below zero on the new scale are discarded.
+
+    Args:
+        values:  The histogram bin values.
+        counts:  The corresponding histogram counts.
+        factor:  The factor by which to scale the bin values.
+
+    Returns:
+        The rebinned histogram, as a dictionary of counts keyed by the new bins.
+    """
+    rescaled = np.round(values * factor).astype(np.int64)
+    populated = rescaled > 0
+    rescaled_counts = np.bincount(
+        rescaled[populated], weights=counts[populated]
+    ).astype(np.int64)
+    rescaled_values = np.flatnonzero(rescaled_counts)
+    return dict(
+        zip(rescaled_values.tolist(), rescaled_counts[rescaled_values].tolist())
+    )
+
+
 def overloads_histogram(d_spacings, ticks=None, output="overloads"):
     # type: (Sequence[float], Optional[Sequence[float]], Optional[str]) -> None
     """
@@ -507,8 +639,8 @@ class Screen19(object):
                 self.expts.extend(importer.experiments)
                 if not self.expts:
                     warning(
-                        "No images found matching template %s"
-                        % self.params.dials_import.input.template[0]
+                        "No images found matching template %s",
+                        self.params.dials_import.input.template[0],
                     )
                     sys.exit(1)
 
@@ -581,27 +713,19 @@ class Screen19(object):
         command = ["xia2.overload", "nproc=%s" % self.nproc, "indexed.expt"]
         debug("running %s", command)
         result = procrunner.run(command, print_stdout=False, debug=procrunner_debug)
-        debug("result = %s", screen19.prettyprint_dictionary(result))
+        if logger.isEnabledFor(logging.DEBUG):
+            debug("result = %s", screen19.prettyprint_dictionary(result))
         info("Successfully completed (%.1f sec)", result["runtime"])
 
         if result["exitcode"] != 0:
             warning("Failed with exit code %d", result["exitcode"])
             sys.exit(1)
 
-        with open("overload.json") as fh:
-            overload_data = json.load(fh)
+        overload_data = _read_overload_data("overload.json")
 
         info("Pixel intensity distribution:")
-        count_sum = 0
-        hist = {}
-        if "bins" in overload_data:
-            for b in range(overload_data["bin_count"]):
-                if overload_data["bins"][b] > 0:
-                    hist[b] = overload_data["bins"][b]
-                    count_sum += b * overload_data["bins"][b]
-        else:
-            hist = {int(k): v for k, v in overload_data["counts"].items() if int(k) > 0}
-            count_sum = sum([k * v for k, v in hist.items()])
+        values, counts = _intensity_histogram(overload_data)
+        count_sum = int(np.dot(values, counts))
 
         average_to_peak = 1
         if mosaicity_correction:
@@ -618,32 +742,28 @@ class Screen19(object):
         scale = 100 * overload_data["scale_factor"] / average_to_peak
         info("Determined scale factor for intensities as %f", scale)
 
-        debug(
-            "intensity histogram: { %s }",
-            ", ".join(["%d:%d" % (k, hist[k]) for k in sorted(hist)]),
-        )
-        max_count = max(hist.keys())
+        if logger.isEnabledFor(logging.DEBUG):
+            debug(
+                "intensity histogram: { %s }",
+                ", ".join("%d:%d" % (k, v) for k, v in zip(values, counts)),
+            )
+        max_count = int(values[-1])
         hist_max = max_count * scale
         hist_granularity, hist_format = 1, "%.0f"
         if hist_max < 50:
             hist_granularity, hist_format = 2, "%.1f"
         if hist_max < 15:
             hist_granularity, hist_format = 10, "%.1f"
-        rescaled_hist = {}
-        for x in hist.keys():
-            rescaled = round(x * scale * hist_granularity)
-            if rescaled > 0:
-                rescaled_hist[rescaled] = hist[x] + rescaled_hist.get(rescaled, 0)
-        hist = rescaled_hist
-        debug(
-            "rescaled histogram: { %s }",
-            ", ".join(
-                [
+        # Rebin the histogram on the scale of percentage of the count rate limit.
+        hist = _rebin_histogram(values, counts, scale * hist_granularity)
+        if logger.isEnabledFor(logging.DEBUG):
+            debug(
+                "rescaled histogram: { %s }",
+                ", ".join(
                     (hist_format + ":%d") % (k / hist_granularity, hist[k])
                     for k in sorted(hist)
-                ]
-            ),
-        )
+                ),
+            )
 
         screen19.plot_intensities(
             hist, 1 / hist_granularity, procrunner_debug=procrunner_debug
@@ -808,7 +928,6 @@ class Screen19(object):
         symb = sg_type.universal_hermann_mauguin_symbol()
         unit_cell = self.expts[0].crystal.get_unit_cell()
 
-        self.refls.as_file(self.params.dials_index.output.reflections)
         self.expts.as_file(self.params.dials_index.output.experiments)
         self.refls.as_file(self.params.dials_index.output.reflections)
         info(
@@ -856,6 +975,10 @@ class Screen19(object):
             warning("dials.refine failed: %d\nGiving up.\n", e)
             sys.exit(1)
 
+        # Overwrite the indexing results, so that the files on disk match.
+        self.expts.as_file(self.params.dials_index.output.experiments)
+        self.refls.as_file(self.params.dials_index.output.reflections)
+
         info("Successfully refined (%.1f sec)", timeit.default_timer() - dials_start)
 
     def _create_profile_model(self):  # type: () -> bool
@@ -869,30 +992,38 @@ class Screen19(object):
             Boolean value indicating whether it was possible to determine a profile
             model from the data.
         """
+        dials_start = timeit.default_timer()
         info("\nCreating profile model...")
-        command = [
-            "dials.create_profile_model",
-            self.params.dials_index.output.experiments,
-            self.params.dials_index.output.reflections,
-            "output = %s" % self.params.dials_index.output.experiments,
-        ]
-        result = procrunner.run(command, print_stdout=False, debug=procrunner_debug)
-        debug("result = %s", screen19.prettyprint_dictionary(result))
+
+        # Use some choice fillets from dials.create_profile_model.  Model the
+        # profile on a copy of just the indexed reflections.
         self._sigma_m = None
-        if result["exitcode"] == 0:
-            db = ExperimentList.from_file(self.params.dials_index.output.experiments)[0]
-            self._oscillation = db.imageset.get_scan().get_oscillation()[1]
-            self._sigma_m = db.profile.sigma_m()
-            info(
-                u"%d images, %s° oscillation, σ_m=%.3f°",
-                db.imageset.get_scan().get_num_images(),
-                str(self._oscillation),
-                self._sigma_m,
+        reference = self.refls.select(self.refls["id"] >= 0)
+        try:
+            reference.compute_zeta_multi(self.expts)
+            reference.compute_d(self.expts)
+            self.expts = ProfileModelFactory.create(
+                self.params.dials_create_profile, self.expts, reference
             )
-            info("Successfully completed (%.1f sec)", result["runtime"])
-            return True
-        warning("Failed with exit code %d", result["exitcode"])
-        return False
+        except Exception as e:
+            # Treat any failure as there being no profile model, so that the
+            # caller can refine the model and try again.
+            warning("Failed: %s", str(e))
+            return False
+
+        self.expts.as_file(self.params.dials_index.output.experiments)
+
+        db = self.expts[0]
+        self._oscillation = db.imageset.get_scan().get_oscillation()[1]
+        self._sigma_m = db.profile.sigma_m()
+        info(
+            u"%d images, %s° oscillation, σ_m=%.3f°",
+            db.imageset.get_scan().get_num_images(),
+            str(self._oscillation),
+            self._sigma_m,
+        )
+        info("Successfully completed (%.1f sec)", timeit.default_timer() - dials_start)
+        return True
 
     def _integrate(self):  # type: () -> None
         """Run `dials.integrate` to integrate reflection intensities."""
@@ -945,12 +1076,10 @@ class Screen19(object):
             info("\nRefining Bravais settings...")
             command = ["dials.refine_bravais_settings", experiments, reflections]
             result = procrunner.run(command, print_stdout=False, debug=procrunner_debug)
-            debug("result = %s", screen19.prettyprint_dictionary(result))
+            if logger.isEnabledFor(logging.DEBUG):
+                debug("result = %s", screen19.prettyprint_dictionary(result))
             if result["exitcode"] == 0:
-                m = re.search(
-                    r"[-+]{3,}\n[^\n]*\n[-+|]{3,}\n(.*\n)*[-+]{3,}",
-                    result["stdout"].decode("utf-8"),
-                )
+                m = _bravais_table.search(result["stdout"].decode("utf-8"))
                 if m:
                     info(m.group(0))
                 else:
@@ -997,19 +1126,26 @@ class Screen19(object):
                 timeit.default_timer() - dials_start,
             )
 
-    def _report(self, experiments, reflections):
-        # type: (ExperimentList, flex.reflection_table) -> None
+    def _report(self, report):
+        # type: (Tuple[subprocess.Popen, IO[bytes], float]) -> None
         """
-        Run `dials.report` on an experiment list and reflection table.
+        Wait for `dials.report` to finish and log the outcome.
 
         Args:
-            experiments:  An experiment list.
-            reflections:  The corresponding reflection table.
+            report:  The running `dials.report`, as returned by `_start_report`.
         """
         info("\nCreating report...")
-        command = ["dials.report", experiments, reflections]
-        result = procrunner.run(command, print_stdout=False, debug=procrunner_debug)
-        debug("result = %s", screen19.prettyprint_dictionary(result))
+        process, output, start = report
+        process.wait()
+        output.seek(0)
+        result = {
+            "exitcode": process.returncode,
+            "runtime": timeit.default_timer() - start,
+            "stdout": output.read(),
+        }
+        output.close()
+        if logger.isEnabledFor(logging.DEBUG):
+            debug("result = %s", screen19.prettyprint_dictionary(result))
         if result["exitcode"] == 0:
             info("Successfully completed (%.1f sec)", result["runtime"])
         #     if sys.stdout.isatty():
@@ -1048,9 +1184,10 @@ class Screen19(object):
             args=args, show_diff_phil=True, return_unhandled=True, quick_parse=True
         )
 
+        dials_version = version.dials_version()
         version_information = "screen19 v%s using %s (%s)" % (
             screen19.__version__,
-            dials.util.version.dials_version(),
+            dials_version,
             time.strftime("%Y-%m-%d %H:%M:%S"),
         )
 
@@ -1145,13 +1282,23 @@ class Screen19(object):
             experiments = self.params.dials_create_profile.output
             reflections = self.params.dials_index.output.reflections
 
-        # This is a hacky check but should work for as long as DIALS 2.0 is supported.
-        if version.dials_version() < "DIALS 2.1":
-            self._refine_bravais(experiments, reflections)
-        else:
-            self._refine_bravais()
-
-        self._report(experiments, reflections)
+        # dials.report runs in a subprocess, independently of the Bravais setting
+        # refinement, so generate the report in the background in the meantime.
+        report = _start_report(experiments, reflections)
+        try:
+            # This is a hacky check but should work for as long as DIALS 2.0 is
+            # supported.
+            if dials_version < "DIALS 2.1":
+                self._refine_bravais(experiments, reflections)
+            else:
+                self._refine_bravais()
+        except BaseException:
+            # Don't wait for the report if the Bravais setting refinement failed.
+            report[0].kill()
+            report[0].wait()
+            raise
+
+        self._report(report)
 
         runtime = timeit.default_timer() - start
         debug(
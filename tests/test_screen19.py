@@ -2,10 +2,24 @@
 
 from __future__ import absolute_import, division, print_function
 
+import json
+
+import numpy as np
 import pytest
 
-from screen19 import minimum_exposure
-from screen19.screen import Screen19
+from screen19 import minimum_exposure, screen
+from screen19.screen import Screen19, _intensity_histogram, _rebin_histogram
+
+# Examples of both layouts of xia2.overload output.
+overload_layouts = [
+    {
+        "scale_factor": 0.0125,
+        "overload_limit": 1000000,
+        "bin_count": 6,
+        "bins": [2, 0, 3, 0, 4, 1],
+    },
+    {"scale_factor": 0.0125, "counts": {"7": 1, "-1": 5, "3": 2, "0": 4}},
+]
 
 # A list of tuples of example sys.argv[1:] cases and associated image count.
 import_checks = [
@@ -28,6 +42,74 @@ import_checks = [
 ]
 
 
+def test_intensity_histogram_bins_layout():
+    overload_data = {"bin_count": 6, "bins": [2, 0, 3, 0, 4, 1]}
+    values, counts = _intensity_histogram(overload_data)
+    assert values.tolist() == [0, 2, 4, 5]
+    assert counts.tolist() == [2, 3, 4, 1]
+
+
+def test_intensity_histogram_counts_layout():
+    """The 'counts' layout is unordered and may include non-positive values."""
+    overload_data = {"counts": {"7": 1, "-1": 5, "3": 2, "0": 4, "12": 6}}
+    values, counts = _intensity_histogram(overload_data)
+    assert values.tolist() == [3, 7, 12]
+    assert counts.tolist() == [2, 1, 6]
+
+
+def test_rebin_histogram_rounding():
+    values = np.array([1, 2, 3, 4, 10, 11])
+    counts = np.array([1, 2, 4, 8, 16, 32])
+    # Scaled values are 0.25, 0.5, 0.75, 1, 2.5, 2.75.  Values are rounded to the
+    # nearest bin (halves to even) and those that land at or below zero dropped.
+    assert _rebin_histogram(values, counts, 0.25) == {1: 12, 2: 16, 3: 32}
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_rebin_histogram_matches_dict_rebinning(seed):
+    """Check against the straightforward dictionary-based rebinning."""
+    rng = np.random.RandomState(seed)
+    values = np.unique(rng.randint(0, 10000, size=200))
+    counts = rng.randint(1, 1000, size=values.size)
+    factor = rng.uniform(0.001, 1)
+
+    expected = {}
+    for x, count in zip(values.tolist(), counts.tolist()):
+        rescaled = int(round(x * factor))
+        if rescaled > 0:
+            expected[rescaled] = count + expected.get(rescaled, 0)
+
+    assert _rebin_histogram(values, counts, factor) == expected
+
+
+@pytest.mark.parametrize("overload_data", overload_layouts)
+def test_read_overload_data(overload_data, monkeypatch, tmpdir):
+    """Check the fallback JSON parser, without pysimdjson."""
+    overload_json = tmpdir.join("overload.json")
+    overload_json.write(json.dumps(overload_data))
+    monkeypatch.setattr(screen, "simdjson", None)
+
+    assert screen._read_overload_data(overload_json.strpath) == overload_data
+
+
+@pytest.mark.parametrize("overload_data", overload_layouts)
+def test_read_overload_data_simdjson(overload_data, monkeypatch, tmpdir):
+    """Check that pysimdjson, if available, gives the same data as the fallback."""
+    simdjson = pytest.importorskip("simdjson")
+    overload_json = tmpdir.join("overload.json")
+    overload_json.write(json.dumps(overload_data))
+
+    monkeypatch.setattr(screen, "simdjson", simdjson)
+    simdjson_data = screen._read_overload_data(overload_json.strpath)
+    monkeypatch.setattr(screen, "simdjson", None)
+    fallback_data = screen._read_overload_data(overload_json.strpath)
+
+    if "bins" in overload_data:
+        assert isinstance(simdjson_data["bins"], np.ndarray)
+        assert simdjson_data.pop("bins").tolist() == fallback_data.pop("bins")
+    assert simdjson_data == fallback_data
+
+
 def test_screen19_command_line_help_does_not_crash():
     Screen19().run([])
 